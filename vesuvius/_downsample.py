@@ -0,0 +1,170 @@
+"""
+2x box-filter downsampling used to build the multiscale pyramids.
+
+Uses numba kernels that write each output pixel directly from its 2x2 (or 2x2x2)
+block of input pixels, parallelized over cache-sized output tiles, for the common
+8/16-bit and boolean data.  Anything else (or a missing numba install) falls back to numpy.
+"""
+
+
+import itertools
+import numpy as np
+try:
+    from numba import njit, prange
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+from .utils import get_chunk_shape, write_chunks
+
+# Side of the output tiles the numba kernels work through
+TILE = 128
+
+
+def downsample_2x(array):
+    """Downsamples an array by a factor of two along every axis by averaging each 2x2
+    (or 2x2x2 for volumes) block of pixels, or taking their logical or for boolean data.
+    Odd-sized edges are handled by repeating the last row/column so that no data is dropped.
+    """
+    if HAS_NUMBA and array.ndim in (2, 3) and array.dtype.type in _KERNELS:
+        downsampled = np.empty(tuple((size + 1) // 2 for size in array.shape), dtype=array.dtype)
+        _KERNELS[array.dtype.type][array.ndim](array, downsampled)
+        return downsampled
+    return downsample_2x_numpy(array)
+
+
+def downsample_level(src, dst):
+    """Fills the zarr array dst with the 2x downsample of the zarr array src, which must
+    share its chunk (or shard) shape.  dst is filled a stripe of chunks at a time (one chunk along
+    every axis but the second), so the matching region of src is exactly the 2x2 (or
+    2x2x2) block of chunks under it and only one stripe is ever in memory.
+    """
+    steps = list(get_chunk_shape(dst))
+    steps[1] = dst.shape[1]
+    for start in itertools.product(*[range(0, size, step) for size, step in zip(dst.shape, steps)]):
+        src_region = tuple(
+            slice(2 * s, 2 * min(s + step, size)) for s, step, size in zip(start, steps, dst.shape)
+        )
+        write_chunks(dst, downsample_2x(src[src_region]), offset=start)
+
+
+def downsample_2x_numpy(array):
+    """Pure numpy implementation of downsample_2x, for any number of dimensions and dtype."""
+    pad = [(0, size % 2) for size in array.shape]
+    if any(after for _, after in pad):
+        array = np.pad(array, pad, mode="edge")
+    blocks = [
+        array[tuple(slice(offset, None, 2) for offset in offsets)]
+        for offsets in itertools.product((0, 1), repeat=array.ndim)
+    ]
+    if array.dtype == np.bool_:
+        return np.logical_or.reduce(blocks)
+    if np.issubdtype(array.dtype, np.integer):
+        # Accumulate in a wider integer type and round to nearest
+        accumulator = np.uint32 if array.dtype.itemsize <= 2 else np.int64
+        total = blocks[0].astype(accumulator)
+        for block in blocks[1:]:
+            total += block
+        total += len(blocks) // 2
+        total >>= array.ndim
+        return total.astype(array.dtype)
+    return (sum(blocks) / len(blocks)).astype(array.dtype)
+
+
+if HAS_NUMBA:
+    # N.B. these kernels are compiled for each input dtype the first time they are called;
+    # with cache=True the compiled code is saved next to this module, so that's only slow
+    # the first time on a given machine rather than in every process.
+    #
+    # The output is split into TILE x TILE tiles that are processed in parallel, so each
+    # thread works through a (2 * TILE) x (2 * TILE) region of the input that stays in cache.
+
+    @njit(parallel=True, boundscheck=False, fastmath=True, cache=True)
+    def box2x2_mean(src, dst):
+        h, w = src.shape
+        n_ti = (dst.shape[0] + TILE - 1) // TILE
+        n_tj = (dst.shape[1] + TILE - 1) // TILE
+        for t in prange(n_ti * n_tj):
+            ti0 = (t // n_tj) * TILE
+            tj0 = (t % n_tj) * TILE
+            for i in range(ti0, min(ti0 + TILE, dst.shape[0])):
+                i0 = 2 * i
+                i1 = min(i0 + 1, h - 1)
+                for j in range(tj0, min(tj0 + TILE, dst.shape[1])):
+                    j0 = 2 * j
+                    j1 = min(j0 + 1, w - 1)
+                    total = (
+                        np.int64(src[i0, j0]) + np.int64(src[i0, j1])
+                        + np.int64(src[i1, j0]) + np.int64(src[i1, j1])
+                    )
+                    dst[i, j] = (total + 2) >> 2
+
+    @njit(parallel=True, boundscheck=False, fastmath=True, cache=True)
+    def box2x2_any(src, dst):
+        h, w = src.shape
+        n_ti = (dst.shape[0] + TILE - 1) // TILE
+        n_tj = (dst.shape[1] + TILE - 1) // TILE
+        for t in prange(n_ti * n_tj):
+            ti0 = (t // n_tj) * TILE
+            tj0 = (t % n_tj) * TILE
+            for i in range(ti0, min(ti0 + TILE, dst.shape[0])):
+                i0 = 2 * i
+                i1 = min(i0 + 1, h - 1)
+                for j in range(tj0, min(tj0 + TILE, dst.shape[1])):
+                    j0 = 2 * j
+                    j1 = min(j0 + 1, w - 1)
+                    dst[i, j] = src[i0, j0] or src[i0, j1] or src[i1, j0] or src[i1, j1]
+
+    @njit(parallel=True, boundscheck=False, fastmath=True, cache=True)
+    def box2x2x2_mean(src, dst):
+        h, w, d = src.shape
+        n_ti = (dst.shape[0] + TILE - 1) // TILE
+        n_tj = (dst.shape[1] + TILE - 1) // TILE
+        for t in prange(n_ti * n_tj):
+            ti0 = (t // n_tj) * TILE
+            tj0 = (t % n_tj) * TILE
+            for i in range(ti0, min(ti0 + TILE, dst.shape[0])):
+                i0 = 2 * i
+                i1 = min(i0 + 1, h - 1)
+                for j in range(tj0, min(tj0 + TILE, dst.shape[1])):
+                    j0 = 2 * j
+                    j1 = min(j0 + 1, w - 1)
+                    for k in range(dst.shape[2]):
+                        k0 = 2 * k
+                        k1 = min(k0 + 1, d - 1)
+                        total = (
+                            np.int64(src[i0, j0, k0]) + np.int64(src[i0, j0, k1])
+                            + np.int64(src[i0, j1, k0]) + np.int64(src[i0, j1, k1])
+                            + np.int64(src[i1, j0, k0]) + np.int64(src[i1, j0, k1])
+                            + np.int64(src[i1, j1, k0]) + np.int64(src[i1, j1, k1])
+                        )
+                        dst[i, j, k] = (total + 4) >> 3
+
+    @njit(parallel=True, boundscheck=False, fastmath=True, cache=True)
+    def box2x2x2_any(src, dst):
+        h, w, d = src.shape
+        n_ti = (dst.shape[0] + TILE - 1) // TILE
+        n_tj = (dst.shape[1] + TILE - 1) // TILE
+        for t in prange(n_ti * n_tj):
+            ti0 = (t // n_tj) * TILE
+            tj0 = (t % n_tj) * TILE
+            for i in range(ti0, min(ti0 + TILE, dst.shape[0])):
+                i0 = 2 * i
+                i1 = min(i0 + 1, h - 1)
+                for j in range(tj0, min(tj0 + TILE, dst.shape[1])):
+                    j0 = 2 * j
+                    j1 = min(j0 + 1, w - 1)
+                    for k in range(dst.shape[2]):
+                        k0 = 2 * k
+                        k1 = min(k0 + 1, d - 1)
+                        dst[i, j, k] = (
+                            src[i0, j0, k0] or src[i0, j0, k1] or src[i0, j1, k0] or src[i0, j1, k1]
+                            or src[i1, j0, k0] or src[i1, j0, k1] or src[i1, j1, k0] or src[i1, j1, k1]
+                        )
+
+    _KERNELS = {
+        np.uint8: {2: box2x2_mean, 3: box2x2x2_mean},
+        np.uint16: {2: box2x2_mean, 3: box2x2x2_mean},
+        np.bool_: {2: box2x2_any, 3: box2x2x2_any},
+    }
+else:
+    _KERNELS = {}
@@ -1,33 +1,90 @@
+import math
 import os
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 import numpy as np
-import skimage
 import tifffile
 import zarr
+try:
+    import pyvips
+except (ImportError, OSError):
+    pyvips = None
+from ._downsample import downsample_level
 from .utils import (
     downsample_slice,
     open_store,
-    get_min_datatype,
+    close_store,
+    create_array,
+    get_chunk_shape,
+    get_min_datatype_from_range,
     get_slice_size,
+    pick_chunks,
+    pick_compressor,
     PapyrusDataException,
     Timer,
+    write_chunks,
+    ZARR_V3,
 )
 
+# Approximate side of the smallest pyramid level.  This is independent of the chunk shapes
+# the arrays are stored with, which are picked from the data with pick_chunks.
 CHUNK_SIZE = 1024
+# Maximum number of (uncompressed) bytes of the smallest pyramid levels to read into memory
+# when opening an image
+PREFETCH_BYTES = 64 * 1024 * 1024
+
+VIPS_DTYPES = {
+    "uchar": np.uint8,
+    "char": np.int8,
+    "ushort": np.uint16,
+    "short": np.int16,
+    "uint": np.uint32,
+    "int": np.int32,
+    "float": np.float32,
+    "double": np.float64,
+}
 
 class PapyrusImage:
-    def __init__(self, zarrpath, imagepath=None, multiscale=True, xlims=None, ylims=None):
+    def __init__(
+        self,
+        zarrpath,
+        imagepath=None,
+        multiscale=True,
+        xlims=None,
+        ylims=None,
+        prefetch_bytes=PREFETCH_BYTES,
+        reuse_buffers=False,
+    ):
         if imagepath is not None:
             self.build_from_image(imagepath, zarrpath, multiscale=multiscale, xlims=xlims, ylims=ylims)  
         if not os.path.exists(zarrpath):
             raise PapyrusDataException(f"Provided zarr path {zarrpath} does not exist.  If generating a new zarr, the path to the image must be provided.")
         self.store, self.zarr = self.load_from_zarr(zarrpath)
         self.multiscale = self.zarr.attrs["multiscale"]
-        self.shape = self.zarr.image.shape
         if self.multiscale:
             self.scale_levels = self.zarr.attrs["scale_levels"]
         else:
             self.scale_levels = 0
+        # Keep direct handles to each scale's array so that indexing doesn't have to go
+        # through the group lookup each time
+        self._arrays = [self.zarr["image"]] + [
+            self.zarr[f"image_downsampled{scale}"] for scale in range(1, self.scale_levels + 1)
+        ]
+        self._scale_shapes = [array.shape for array in self._arrays]
+        self._max_scale_size = CHUNK_SIZE // 4
+        self.shape = self._scale_shapes[0]
+        self._cached_levels = self.prefetch(prefetch_bytes)
+        # With reuse_buffers, reads of up to a chunk are decoded into a per-scale scratch
+        # buffer instead of a fresh array.  The returned array is then only valid until the
+        # next read at the same scale.  zarr 3 can only decode into its own buffer types, so
+        # this is a no-op there.
+        self._scratch = {}
+        if reuse_buffers and not ZARR_V3:
+            self._scratch = {
+                scale: np.empty(array.chunks, dtype=array.dtype)
+                for scale, array in enumerate(self._arrays)
+                if scale not in self._cached_levels
+            }
     
     def __getitem__(self, key):
         if len(key) == 2:
@@ -35,16 +92,15 @@ class PapyrusImage:
             # to grab from so that we don't get more data than we'll use.
             x, y = key
             if isinstance(x, int) or isinstance(y, int):
-                return self.zarr.image.__getitem__(key)
+                return self._arrays[0][key]
             scale_size = max(
                 get_slice_size(x, self.shape[0]), 
                 get_slice_size(y, self.shape[1]),
             )
+            # Pick the smallest downsampling that gets the slice under a quarter of CHUNK_SIZE
             scale = 0
-            while (scale < self.scale_levels) and scale_size > (CHUNK_SIZE // 4):
-                scale += 1
-                scale_size = scale_size // 2
-            print(scale)
+            if scale_size > self._max_scale_size:
+                scale = min(self.scale_levels, math.ceil(math.log2(scale_size / self._max_scale_size)))
         elif len(key) == 3:
             x, y, scale = key
         else:
@@ -57,81 +113,209 @@ class PapyrusImage:
             raise PapyrusDataException("Cannot index negative sampled images")
         if scale > self.scale_levels:
             raise PapyrusDataException(f"Only {self.scale_levels} downsampled images in this library")
-        subimage = "image" if scale == 0 else f"image_downsampled{scale}"
         x = downsample_slice(x, scale)
         y = downsample_slice(y, scale)
-        return self.zarr.__getattr__(subimage).__getitem__((x, y))
+        if scale in self._cached_levels:
+            # Copy so that, as with any other read, callers get an array they can modify
+            return self._cached_levels[scale][(x, y)].copy()
+        if scale in self._scratch and isinstance(x, slice) and isinstance(y, slice):
+            height = len(range(*x.indices(self._scale_shapes[scale][0])))
+            width = len(range(*y.indices(self._scale_shapes[scale][1])))
+            scratch = self._scratch[scale]
+            if height <= scratch.shape[0] and width <= scratch.shape[1]:
+                out = scratch[:height, :width]
+                self._arrays[scale].get_basic_selection((x, y), out=out)
+                return out
+        return self._arrays[scale][(x, y)]
+
+    def prefetch(self, max_bytes):
+        """Reads as many of the smallest pyramid levels as fit in max_bytes fully into
+        memory, in parallel, so that zoomed-out views don't have to go back to the store.
+        The full-resolution image is never read.  Returns a dictionary of read-only arrays
+        keyed by scale.
+        """
+        scales = []
+        total = 0
+        for scale in range(self.scale_levels, 0, -1):
+            total += self._arrays[scale].nbytes
+            if total > max_bytes:
+                break
+            scales.append(scale)
+        if not scales:
+            return {}
+        with Timer("Prefetching downsampled images"):
+            with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+                futures = {
+                    scale: executor.submit(self._arrays[scale].__getitem__, Ellipsis)
+                    for scale in scales
+                }
+            cached_levels = {scale: future.result() for scale, future in futures.items()}
+        for array in cached_levels.values():
+            array.flags.writeable = False
+        return cached_levels
     
     def close(self):
-        self.store.close()
+        close_store(self.store)
 
     @staticmethod
     def load_from_zarr(filepath):
         with Timer("Loading from existing zarr"):
             store = open_store(filepath)
-            root = zarr.group(store=store, overwrite=False)
+            root = zarr.open_group(store=store, mode="r")
             return store, root
     
     @staticmethod
     def build_from_image(imagepath, zarrpath, chunk_size=None, multiscale=True, xlims=None, ylims=None):
-        if chunk_size is None:
-            chunk_size = (CHUNK_SIZE, CHUNK_SIZE)
         if os.path.exists(zarrpath):
             raise PapyrusDataException(f"Provided zarr path {zarrpath} already exists.  Please remove before initiation so that we do not overwrite.")
         print(f"Building zarr from {imagepath}")
-        # tifffile is much faster, so we use it when possible
-        with Timer("Loading image data"):
-            if imagepath.endswith(".tiff") or imagepath.endswith(".tif"):
-                img_data = tifffile.imread(imagepath)
-            else:
-                img_data = np.array(Image.open(imagepath))
-        with Timer("Storing full image data"):
-            img_data = img_data.astype(get_min_datatype(img_data))
-            if xlims is not None:
-                xmin, xmax = xlims
-                xslice = slice(xmin, xmax, None)
-            else:
-                xslice = slice(None, None, None)
-            if ylims is not None:
-                ymin, ymax = ylims
-                yslice = slice(ymin, ymax, None)
-            else:
-                yslice = slice(None, None, None)
-            img_data = img_data[xslice,yslice]
-            store = open_store(zarrpath, "w")
-            root = zarr.group(store=store, overwrite=True)
-            root.array(
-                name="image", 
-                data=img_data, 
-                chunks=chunk_size, 
-                compressor="default", 
-                write_empty_chunks=False, 
-                fill_value=0,
-            )
+        xslice = slice(*xlims) if xlims is not None else slice(None)
+        yslice = slice(*ylims) if ylims is not None else slice(None)
+        store = open_store(zarrpath, "w")
+        root = zarr.group(store=store, overwrite=True)
+        is_tiff = imagepath.endswith(".tiff") or imagepath.endswith(".tif")
+        image = None
+        if pyvips is not None and not is_tiff:
+            # libvips can decode other formats a stripe at a time, so we never hold more
+            # than a row of chunks of the decoded image in memory
+            with Timer("Streaming image data"):
+                image = PapyrusImage.stream_from_vips(imagepath, root, chunk_size, xslice, yslice)
+        if image is None:
+            # tifffile is much faster, so we use it when possible
+            with Timer("Loading image data"):
+                if is_tiff and (xlims is not None or ylims is not None):
+                    # Only read the tiles/strips of the tiff that we need
+                    img_data = tifffile.imread(imagepath, selection=(xslice, yslice))
+                elif is_tiff:
+                    img_data = tifffile.imread(imagepath)
+                else:
+                    img_data = np.array(Image.open(imagepath))
+            with Timer("Storing full image data"):
+                if not is_tiff and (xlims is not None or ylims is not None):
+                    img_data = img_data[xslice,yslice]
+                # Only copy the data if we can actually shrink the datatype
+                min_dtype = get_min_datatype_from_range(img_data.min(), img_data.max())
+                if min_dtype != img_data.dtype:
+                    img_data = img_data.astype(min_dtype)
+                if chunk_size is None:
+                    chunk_size = pick_chunks(img_data.shape, img_data.dtype)
+                image = create_array(
+                    root,
+                    name="image", 
+                    shape=img_data.shape, 
+                    chunks=chunk_size, 
+                    dtype=img_data.dtype, 
+                    compressor=pick_compressor(img_data.dtype), 
+                )
+                write_chunks(image, img_data)
+            del img_data
+        chunk_size = get_chunk_shape(image)
         # Serially add 2x downsampled copies of the image into the group until the size of the 
-        # downsampled image is smaller than a quarter of a chunk.
+        # downsampled image is no larger than CHUNK_SIZE.
         root.attrs["multiscale"] = multiscale
         if multiscale:
             scale_levels = int(max(
-                np.ceil(np.log2(img_data.shape[0] / (chunk_size[0] // 1))),
-                np.ceil(np.log2(img_data.shape[1] / (chunk_size[1] // 1))),
+                np.ceil(np.log2(image.shape[0] / CHUNK_SIZE)),
+                np.ceil(np.log2(image.shape[1] / CHUNK_SIZE)),
+                0,
             ))
             scale_levels = min(10, scale_levels)
             root.attrs["scale_levels"] = scale_levels
             with Timer("Generating downsampled images"):
+                # Each level is generated chunk-by-chunk from the previous one rather than
+                # from the full-resolution image, so the total work is a geometric series.
+                prev = image
                 for scale in range(1, scale_levels + 1):
-                    anti_aliasing = True
-                    if img_data.dtype in [np.bool8, np.bool_]:
-                        anti_aliasing = False
-                    resized_img = skimage.transform.rescale(
-                        img_data, 1 / 2 ** scale, preserve_range=True, anti_aliasing=anti_aliasing,
-                    ).astype(img_data.dtype)
-                    root.array(
+                    image_downsampled = create_array(
+                        root,
                         name=f"image_downsampled{scale}",
-                        data=resized_img,
+                        shape=tuple((size + 1) // 2 for size in prev.shape),
                         chunks=chunk_size,
-                        compressor="default",
-                        write_empty_chunks=False,
-                        fill_value=0,
+                        dtype=prev.dtype,
+                        compressor=pick_compressor(prev.dtype, tail=True),
                     )
-        store.close()
\ No newline at end of file
+                    downsample_level(prev, image_downsampled)
+                    prev = image_downsampled
+        close_store(store)
+
+    @staticmethod
+    def stream_from_vips(imagepath, root, chunk_size=None, xslice=slice(None), yslice=slice(None)):
+        """Decodes a single-band image with pyvips a row of chunks at a time and writes it
+        straight into a new "image" array in root, with the smallest datatype that fits the
+        data.  Returns the array, or None without writing anything if the image has more
+        than one band, which we leave to Pillow.
+        """
+        vips_img = PapyrusImage._open_vips(imagepath, xslice, yslice)
+        if vips_img.bands != 1:
+            return None
+        vips_dtype = VIPS_DTYPES[vips_img.format]
+        # libvips decodes 1-bit images to 0/255, so we convert those back to booleans
+        is_binary = bool(vips_img.get_typeof("bits-per-sample")) and vips_img.get("bits-per-sample") == 1
+        if is_binary:
+            dtype = np.dtype(np.bool_)
+        elif vips_dtype == np.uint8:
+            # 8-bit data can only narrow to booleans, which we check for while writing
+            # rather than decoding the image an extra time up front
+            dtype = np.dtype(np.uint8)
+        else:
+            # Find the data range with a first, write-free decoding pass so that the array
+            # is only ever written once, with its final datatype.  Sequential images can
+            # only be read once, so we then open the file again for the data itself.
+            stats = vips_img.stats()
+            amin, amax = vips_dtype(stats(0, 0)[0]), vips_dtype(stats(1, 0)[0])
+            dtype = get_min_datatype_from_range(amin, amax)
+            vips_img = PapyrusImage._open_vips(imagepath, xslice, yslice)
+        image, amax = PapyrusImage._write_vips(vips_img, root, chunk_size, dtype, is_binary)
+        if dtype == np.uint8 and amax <= 1:
+            # The data turned out to be a 0/1 mask, so we decode it again as booleans
+            del root["image"]
+            vips_img = PapyrusImage._open_vips(imagepath, xslice, yslice)
+            image, _ = PapyrusImage._write_vips(vips_img, root, chunk_size, np.dtype(np.bool_), False)
+        return image
+
+    @staticmethod
+    def _write_vips(vips_img, root, chunk_size, dtype, is_binary):
+        """Streams a pyvips image into a new "image" array in root with the given datatype.
+        Returns the array and the maximum (decoded) value of the data.
+        """
+        vips_dtype = VIPS_DTYPES[vips_img.format]
+        shape = (vips_img.height, vips_img.width)
+        if chunk_size is None:
+            chunk_size = pick_chunks(shape, dtype)
+        image = create_array(
+            root,
+            name="image",
+            shape=shape,
+            chunks=chunk_size,
+            dtype=dtype,
+            compressor=pick_compressor(dtype),
+        )
+        # Fetching through a single region keeps the reads in order, which sequential
+        # access requires
+        region = pyvips.Region.new(vips_img)
+        amax = 0
+        for x0 in range(0, shape[0], chunk_size[0]):
+            height = min(chunk_size[0], shape[0] - x0)
+            stripe = np.ndarray(
+                buffer=region.fetch(0, x0, shape[1], height),
+                dtype=vips_dtype,
+                shape=(height, shape[1]),
+            )
+            amax = max(amax, stripe.max())
+            if is_binary:
+                stripe = stripe > 0
+            elif dtype != stripe.dtype:
+                stripe = stripe.astype(dtype)
+            write_chunks(image, stripe, offset=(x0, 0))
+        return image, amax
+
+    @staticmethod
+    def _open_vips(imagepath, xslice, yslice):
+        vips_img = pyvips.Image.new_from_file(imagepath, access="sequential")
+        xstart, xstop, _ = xslice.indices(vips_img.height)
+        ystart, ystop, _ = yslice.indices(vips_img.width)
+        shape = (max(0, xstop - xstart), max(0, ystop - ystart))
+        if shape != (vips_img.height, vips_img.width):
+            # Cropping lets libvips skip decoding anything it doesn't have to
+            vips_img = vips_img.crop(ystart, xstart, shape[1], shape[0])
+        return vips_img
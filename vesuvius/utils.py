@@ -1,7 +1,25 @@
+import collections
+import itertools
 import time
 import numpy as np
 import os
 import zarr
+from concurrent.futures import ThreadPoolExecutor
+from numcodecs import Blosc
+
+ZARR_V3 = int(zarr.__version__.split(".")[0]) >= 3
+# Under zarr 3, the chunk shapes we pick are used as shards, with each xy side split into
+# up to SHARD_SPLIT inner chunks of no less than MIN_INNER_CHUNK pixels.
+SHARD_SPLIT = 8
+MIN_INNER_CHUNK = 128
+# Target number of (uncompressed) bytes per chunk when picking chunk shapes
+CHUNK_BYTES = 8 * 1024 * 1024
+# Maximum number of bytes of chunk data cached in memory by stores opened for reading
+STORE_CACHE_SIZE = 512 * 1024 * 1024
+
+# Candidate integer datatypes for get_min_datatype, from smallest to largest
+UNSIGNED_DTYPES = (np.uint8, np.uint16, np.uint32, np.uint64)
+SIGNED_DTYPES = (np.int8, np.int16, np.int32, np.int64)
 
 class TimerError(Exception):
     pass
@@ -50,10 +68,23 @@ def get_min_datatype(array):
     """Given a numpy array, tries to find the smallest possible datatype that will
     fit the data.
     """
-    dtype = np.find_common_type([np.min_scalar_type(array.min()), np.min_scalar_type(array.max())], [])
-    if (dtype == np.uint8) and array.max() in [0, 1]:
-        return np.bool8
-    return dtype
+    return get_min_datatype_from_range(array.min(), array.max())
+
+def get_min_datatype_from_range(amin, amax):
+    """Given the minimum and maximum values of some data, finds the smallest possible
+    datatype that will fit the data.
+    """
+    if not isinstance(amin, (bool, int, np.bool_, np.integer)):
+        return np.result_type(np.min_scalar_type(amin), np.min_scalar_type(amax))
+    amin, amax = int(amin), int(amax)
+    if amin >= 0 and amax <= 1:
+        return np.dtype(np.bool_)
+    dtypes = UNSIGNED_DTYPES if amin >= 0 else SIGNED_DTYPES
+    for dtype in dtypes:
+        info = np.iinfo(dtype)
+        if info.min <= amin and amax <= info.max:
+            return np.dtype(dtype)
+    raise PapyrusDataException(f"No integer datatype can hold the range [{amin}, {amax}]")
 
 def downsample_slice(item, scale):
     """Given a downsampled scale factor (a non-negative integer), downsamples an input slice to
@@ -82,19 +113,173 @@ def get_slice_size(item, dimsize):
     stop = dimsize if item.stop is None else item.stop
     return stop - start
 
+def pick_chunks(shape, dtype, target_bytes=CHUNK_BYTES, max_depth=64):
+    """Picks the largest chunk shape that fits in target_bytes for an array of the given
+    shape and dtype.  Chunks are square in xy, with a power-of-two side so that chunk
+    boundaries line up between pyramid levels.  For volumes, chunks span up to max_depth
+    planes in z.
+    """
+    itemsize = np.dtype(dtype).itemsize
+    depth = min(shape[2], max_depth) if len(shape) == 3 else 1
+    side = max(1, int(np.sqrt(target_bytes / (itemsize * depth))))
+    side = 2 ** (side.bit_length() - 1)
+    if len(shape) == 3:
+        return (side, side, depth)
+    return (side, side)
+
+def pick_compressor(dtype, tail=False):
+    """Picks a Blosc compressor suited to the data being stored.  Masks and 8-bit data
+    compress best bit-shuffled with zstd.  Wider full-resolution data uses fast lz4 so that
+    reads in the viewer are cheap, while pyramid tail levels (tail=True) use a higher zstd
+    level since they are small and size matters more than decode speed.
+    """
+    dtype = np.dtype(dtype)
+    if dtype == np.bool_ or dtype.itemsize == 1:
+        return Blosc(cname="zstd", clevel=3, shuffle=Blosc.BITSHUFFLE)
+    if tail:
+        return Blosc(cname="zstd", clevel=5, shuffle=Blosc.SHUFFLE)
+    return Blosc(cname="lz4", clevel=1, shuffle=Blosc.SHUFFLE)
+
+def write_chunks(array, data, offset=None):
+    """Writes data into a zarr array at the given (chunk-aligned) offset, one chunk per
+    task on a thread pool.  Compression releases the GIL and each chunk is stored
+    independently, so this scales with the number of cores.  For sharded arrays, each
+    task writes a whole shard so that no two threads touch the same shard file.
+    """
+    if offset is None:
+        offset = (0,) * data.ndim
+    chunks = get_chunk_shape(array)
+    starts = itertools.product(*[range(0, size, chunk) for size, chunk in zip(data.shape, chunks)])
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        futures = []
+        for start in starts:
+            src = tuple(slice(s, s + chunk) for s, chunk in zip(start, chunks))
+            dst = tuple(slice(o + s, o + s + chunk) for o, s, chunk in zip(offset, start, chunks))
+            futures.append(executor.submit(array.__setitem__, dst, data[src]))
+        for future in futures:
+            future.result()
+
 def get_dir_size(path):
+    """Gets the total size in bytes of the files under a directory, without following
+    symlinks.  Each top-level subdirectory (e.g. each array of a directory store) is
+    walked on its own thread, since the time is spent waiting on stat calls.
+    """
     total = 0
+    subdirs = []
     with os.scandir(path) as it:
         for entry in it:
-            if entry.is_file():
-                total += entry.stat().st_size
-            elif entry.is_dir():
-                total += get_dir_size(entry.path)
+            if entry.is_file(follow_symlinks=False):
+                total += entry.stat(follow_symlinks=False).st_size
+            elif entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        total += sum(executor.map(_get_tree_size, subdirs))
+    return total
+
+def _get_tree_size(path):
+    total = 0
+    queue = collections.deque([path])
+    while queue:
+        with os.scandir(queue.popleft()) as it:
+            for entry in it:
+                if entry.is_file(follow_symlinks=False):
+                    total += entry.stat(follow_symlinks=False).st_size
+                elif entry.is_dir(follow_symlinks=False):
+                    queue.append(entry.path)
+    return total
+
+def get_store_size(root):
+    """Gets the total stored (compressed) size in bytes of all the arrays in a zarr group,
+    asking the store for the sizes rather than walking the filesystem ourselves.
+    """
+    total = 0
+    for _, array in root.arrays():
+        # This is a property in zarr 2 but a method in zarr 3
+        nbytes_stored = array.nbytes_stored
+        total += nbytes_stored() if callable(nbytes_stored) else nbytes_stored
     return total
 
 def open_store(filepath, mode="r"):
     """We're going to abstract the store out to this function so that
     we can experiment with different store types across the 
     whole project easily.
+
+    Stores are directories of chunk (or, under zarr 3, shard) files so that they can be
+    read and written concurrently; under zarr 2, reads go through an in-memory LRU cache.
+    Zip files (e.g. a zipped up store directory) are supported as a read-only single-file
+    alternative.
+    """
+    if os.path.isfile(filepath) and not filepath.endswith(".zip"):
+        # Stores used to be single SQLite files, which we can no longer read
+        raise PapyrusDataException(f"{filepath} is a file rather than a zarr directory; it was likely built in the old SQLite format and must be removed and rebuilt.")
+    if filepath.endswith(".zip"):
+        if mode != "r":
+            raise PapyrusDataException("Zip stores are read-only")
+        if ZARR_V3:
+            return zarr.storage.ZipStore(filepath, mode="r")
+        return zarr.ZipStore(filepath, mode="r")
+    if ZARR_V3:
+        return zarr.storage.LocalStore(filepath, read_only=(mode == "r"))
+    if mode == "r":
+        return zarr.LRUStoreCache(zarr.DirectoryStore(filepath), max_size=STORE_CACHE_SIZE)
+    return zarr.DirectoryStore(filepath)
+
+def create_array(root, name, shape, chunks, dtype, compressor):
+    """Creates an empty (zero-filled) array in the group root.  Under zarr 2, chunks is the
+    chunk shape.  Under zarr 3, chunks is the shard shape, split into smaller inner chunks so
+    that partial reads stay cheap while the store holds far fewer files.
+    """
+    if ZARR_V3:
+        return root.create_array(
+            name=name,
+            shape=shape,
+            dtype=dtype,
+            shards=chunks,
+            chunks=get_inner_chunks(chunks),
+            compressors=[_to_blosc_codec(compressor)],
+            fill_value=0,
+            config={"write_empty_chunks": False},
+        )
+    return root.zeros(
+        name=name,
+        shape=shape,
+        chunks=chunks,
+        dtype=dtype,
+        compressor=compressor,
+        write_empty_chunks=False,
+    )
+
+def get_chunk_shape(array):
+    """Gets the shape of the independently stored blocks of an array: the shard shape for
+    sharded arrays, and the chunk shape otherwise.
+    """
+    shards = getattr(array, "shards", None)
+    return array.chunks if shards is None else shards
+
+def get_inner_chunks(shards):
+    """Splits a shard shape into the inner chunk shape, cutting each xy side into up to
+    SHARD_SPLIT pieces of no less than MIN_INNER_CHUNK pixels.  Sides that can't be split
+    evenly are left whole, as is z.
+    """
+    inner = list(shards)
+    for axis, size in enumerate(shards[:2]):
+        split = max(size // SHARD_SPLIT, MIN_INNER_CHUNK)
+        if split < size and size % split == 0:
+            inner[axis] = split
+    return tuple(inner)
+
+def _to_blosc_codec(compressor):
+    shuffle = {
+        Blosc.NOSHUFFLE: "noshuffle",
+        Blosc.SHUFFLE: "shuffle",
+        Blosc.BITSHUFFLE: "bitshuffle",
+    }[compressor.shuffle]
+    return zarr.codecs.BloscCodec(cname=compressor.cname, clevel=compressor.clevel, shuffle=shuffle)
+
+def close_store(store):
+    """Closes a store opened with open_store.  Directory stores hold no open handles,
+    so this is a no-op for them.
     """
-    return zarr.SQLiteStore(filepath)
+    close = getattr(store, "close", None)
+    if close is not None:
+        close()
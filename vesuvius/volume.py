@@ -1,17 +1,27 @@
+import math
 import os
 import numpy as np
-import skimage
 import tifffile
 import zarr
+from ._downsample import downsample_level
 from .utils import (
     downsample_slice,
     open_store,
+    close_store,
+    create_array,
     get_slice_size,
+    pick_chunks,
+    pick_compressor,
     PapyrusDataException,
     Timer,
+    write_chunks,
 )
 
+# Approximate side of the smallest pyramid level.  This is independent of the chunk shapes
+# the arrays are stored with, which are picked from the data with pick_chunks.
 CHUNK_SIZE = 1024
+# Number of z-planes per chunk; tiff files are loaded and written in blocks of this many planes
+ZCHUNK_SIZE = 64
 
 class PapyrusVolume:
     def __init__(self, zarrpath, tiffdirpath=None, multiscale=True, xlims=None, ylims=None, zlims=None, zstride=None):
@@ -21,11 +31,19 @@ class PapyrusVolume:
             raise PapyrusDataException(f"Provided zarr path {zarrpath} does not exist.  If generating a new zarr, the path to the image must be provided.")
         self.store, self.zarr = self.load_from_zarr(zarrpath)
         self.multiscale = self.zarr.attrs["multiscale"]
-        self.shape = self.zarr.volume.shape
+        # Volumes built before the projection was stored during ingest won't have it
+        self.max_projection = self.zarr["max_projection"] if "max_projection" in self.zarr else None
         if self.multiscale:
             self.scale_levels = self.zarr.attrs["scale_levels"]
         else:
             self.scale_levels = 0
+        # Keep direct handles to each scale's array so that indexing doesn't have to go
+        # through the group lookup each time
+        self._arrays = [self.zarr["volume"]] + [
+            self.zarr[f"volume_downsampled{scale}"] for scale in range(1, self.scale_levels + 1)
+        ]
+        self.shape = self._arrays[0].shape
+        self._max_scale_size = CHUNK_SIZE // 4
     
     def __getitem__(self, key):
         if len(key) == 3:
@@ -33,16 +51,16 @@ class PapyrusVolume:
             # to grab from so that we don't get more data than we'll use.
             x, y, z = key
             if isinstance(x, int) or isinstance(y, int) or isinstance(z, int):
-                return self.zarr.volume.__getitem__(key)
+                return self._arrays[0][key]
             scale_size = max(
                 get_slice_size(x, self.shape[0]), 
                 get_slice_size(y, self.shape[1]),
                 get_slice_size(z, self.shape[2]),
             )
+            # Pick the smallest downsampling that gets the slice under a quarter of CHUNK_SIZE
             scale = 0
-            while (scale < self.scale_levels) and scale_size > (CHUNK_SIZE // 4):
-                scale += 1
-                scale_size = scale_size // 2
+            if scale_size > self._max_scale_size:
+                scale = min(self.scale_levels, math.ceil(math.log2(scale_size / self._max_scale_size)))
         elif len(key) == 4:
             x, y, z, scale = key
         else:
@@ -55,20 +73,19 @@ class PapyrusVolume:
             raise PapyrusDataException("Cannot index negative sampled images")
         if scale > self.scale_levels:
             raise PapyrusDataException(f"Only {self.scale_levels} downsampled images in this library")
-        subimage = "volume" if scale == 0 else f"volume_downsampled{scale}"
         x = downsample_slice(x, scale)
         y = downsample_slice(y, scale)
         z = downsample_slice(z, scale)
-        return self.zarr.__getattr__(subimage).__getitem__((x, y, z))
+        return self._arrays[scale][(x, y, z)]
     
     def close(self):
-        self.store.close()
+        close_store(self.store)
     
     @staticmethod
     def load_from_zarr(filepath):
         with Timer("Loading from existing zarr"):
             store = open_store(filepath)
-            root = zarr.group(store=store, overwrite=False)
+            root = zarr.open_group(store=store, mode="r")
             return store, root
     
     @staticmethod
@@ -82,8 +99,6 @@ class PapyrusVolume:
         zlims=None,
         zstride=None,
     ):
-        if chunk_size is None:
-            chunk_size = (CHUNK_SIZE, CHUNK_SIZE, 1)
         if os.path.exists(zarrpath):
             raise PapyrusDataException(f"Provided zarr path {zarrpath} already exists.  Please remove before initiation so that we do not overwrite.")
         print(f"Building zarr from {tiffdirpath}")
@@ -118,54 +133,76 @@ class PapyrusVolume:
         with Timer("Loading tiff files"):
             store = open_store(zarrpath, mode="w")
             root = zarr.group(store=store, overwrite=True)
-            for z_index, img_index in enumerate(zrange):
-                imgfile = imgfiles[img_index]
-                print(f"Loading file {imgfile}", end="\r")
-                img_data = tifffile.imread(imgfile)[xslice, yslice]
+            # Load the tiffs a z-chunk at a time, decoding the files in parallel into a
+            # reused buffer, so that each chunk of the volume is written exactly once.
+            zblock = ZCHUNK_SIZE if chunk_size is None else chunk_size[2]
+            with tifffile.TiffFile(imgfiles[zrange[0]]) as tif:
+                page = tif.pages[0]
+                block_buffer = np.empty((zblock,) + page.shape, dtype=page.dtype)
+            for z0 in range(0, len(zrange), zblock):
+                block_files = [imgfiles[img_index] for img_index in zrange[z0:z0 + zblock]]
+                print(f"Loading files {block_files[0]} to {block_files[-1]}", end="\r")
+                block_data = tifffile.imread(
+                    block_files, out=block_buffer[:len(block_files)], ioworkers=os.cpu_count(),
+                )
+                block_data = block_data.reshape((len(block_files),) + block_data.shape[-2:])
+                block_data = block_data[:, xslice, yslice]
                 if init:
-                    volume = root.zeros(
+                    shape = (block_data.shape[1], block_data.shape[2], len(zrange))
+                    if chunk_size is None:
+                        chunk_size = pick_chunks(shape, block_data.dtype, max_depth=ZCHUNK_SIZE)
+                    volume = create_array(
+                        root,
                         name="volume",
-                        shape=(img_data.shape[0], img_data.shape[1], len(zrange)),
+                        shape=shape,
                         chunks=chunk_size,
-                        dtype=img_data.dtype,
-                        write_empty_chunks=False,
+                        dtype=block_data.dtype,
+                        compressor=pick_compressor(block_data.dtype),
                     )
+                    # The maximum projection along z is accumulated as we go, while each
+                    # block is still in memory
+                    max_projection = np.zeros(shape[:2], dtype=block_data.dtype)
                     init = False
-                volume[:,:,z_index] = img_data
+                write_chunks(volume, block_data.transpose(1, 2, 0), offset=(0, 0, z0))
+                np.maximum(max_projection, block_data.max(axis=0), out=max_projection)
             # We need this to clear out the \r from the last print statement
             print()
-            
-        # TODO: let's add the maximum image-projection along the z-axis here as well
-            
-        # For 3D multisampling, we'll do a nice 2D downsample in xy but just stride along the
-        # z-axis.  At some point we should revisit this to get better behavior, but this
-        # should be sufficient for now.
+            write_chunks(
+                create_array(
+                    root,
+                    name="max_projection",
+                    shape=max_projection.shape,
+                    chunks=pick_chunks(max_projection.shape, max_projection.dtype),
+                    dtype=max_projection.dtype,
+                    compressor=pick_compressor(max_projection.dtype),
+                ),
+                max_projection,
+            )
+
+        # Each level is downsampled 2x along every axis from the previous level, a stripe
+        # of chunks at a time, so that we never go back to the full-resolution data.
         root.attrs["multiscale"] = multiscale
         if multiscale:
             scale_levels = int(max(
-                np.ceil(np.log2(img_data.shape[0] / (chunk_size[0] // 1))),
-                np.ceil(np.log2(img_data.shape[1] / (chunk_size[1] // 1))),
+                np.ceil(np.log2(volume.shape[0] / CHUNK_SIZE)),
+                np.ceil(np.log2(volume.shape[1] / CHUNK_SIZE)),
+                0,
             ))
             scale_levels = min(10, scale_levels)
             root.attrs["scale_levels"] = scale_levels
             with Timer("Generating downsampled images"):
+                prev_name = "volume"
                 for scale in range(1, scale_levels + 1):
-                    ds_zrange = np.arange(len(zrange))[::(2 ** scale)]
-                    init = True
-                    for new_zindex, old_zindex in enumerate(ds_zrange):
-                        img_data = volume[:,:,old_zindex]
-                        resized_img = skimage.transform.rescale(
-                            img_data, 1 / 2 ** scale, preserve_range=True, anti_aliasing=True
-                        ).astype(img_data.dtype)
-                        if init:
-                            volume_downsampled = root.zeros(
-                                name=f"volume_downsampled{scale}",
-                                shape=(resized_img.shape[0], resized_img.shape[1], len(ds_zrange)),
-                                chunks=chunk_size,
-                                compressor="default",
-                                write_empty_chunks=False,
-                            )
-                            init = False
-                        volume_downsampled[:,:,new_zindex] = resized_img
+                    prev = root[prev_name]
+                    volume_downsampled = create_array(
+                        root,
+                        name=f"volume_downsampled{scale}",
+                        shape=tuple((size + 1) // 2 for size in prev.shape),
+                        chunks=chunk_size,
+                        dtype=prev.dtype,
+                        compressor=pick_compressor(prev.dtype, tail=True),
+                    )
+                    downsample_level(prev, volume_downsampled)
+                    prev_name = f"volume_downsampled{scale}"
 
-        store.close()
\ No newline at end of file
+        close_store(store)
\ No newline at end of file